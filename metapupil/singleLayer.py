@@ -1,10 +1,9 @@
 import numpy as np
-import matplotlib.pyplot as pl
-from ipdb import set_trace as stop
-import seaborn as sns
 import tomography
 
 def plotResults(forward, inversion, index):
+    import matplotlib.pyplot as pl
+
     f, ax = pl.subplots(nrows=2, ncols=1, figsize=(12,10))
     ax[0].plot(inversion.aStack['SVD'], label='SVD')
     ax[0].plot(forward.aStack['Original'], label='Original')
@@ -14,7 +13,6 @@ def plotResults(forward, inversion, index):
     ax[1].legend()
 
 np.random.seed(123)
-sns.set_style("dark")
 nStars = 7
 nZernike = 30
 fov = 60.0
@@ -32,14 +30,18 @@ reconstructed = np.zeros((nHeights,nZernike*len(heights),nNoises))
 
 noiseStd = 0.1
 forward = tomography.tomography(nStars, nZernike, fov, heights, DTel)
+
+# The inversion geometry and its covariance are the same for every test height, so
+# build them once and only re-solve inside the loop
+inversion = tomography.tomography(nStars, nZernike, fov, heights, DTel)
+inversion.generateTurbulentZernikesKolmogorov(r0, layers=[0.0], percentages=[100.0])
+
 j = 0
-for i in range(nHeights):    
+for i in range(nHeights):
     forward.generateTurbulentZernikesKolmogorov(r0, layers=[testHeights[i]], percentages=[100.0])
     bMeasured = forward.generateWFS()
     bMeasured += np.random.normal(scale=noiseStd, size=bMeasured.shape)
 
-    inversion = tomography.tomography(nStars, nZernike, fov, heights, DTel)
-    inversion.generateTurbulentZernikesKolmogorov(r0, layers=[0.0], percentages=[100.0])
     inversion.solveSVD(bMeasured, regularize=True)
 
         # inversion.solveFASTA(bMeasured, mu=0.05)
@@ -3,23 +3,71 @@ import numpy as np
 import scipy.special as sp
 import scipy.linalg as spla
 import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
 import scipy.integrate as integ
-import matplotlib.pyplot as pl
 import pyiacsun as ps
-from ipdb import set_trace as stop
-import seaborn as sns
+from numba import njit
+from joblib import Parallel, delayed
 import uuid
 import glob
+import warnings
 import wavefront as wf
 
-def even(x):
-    return x%2 == 0
+# Module-level cache with the projection tensor M and its stacked version, shared by
+# reference between all tomography instances with the same geometry
+_M_CACHE = {}
+
+# Terms of the von Karman k-series that only depend on k, fixed at module import:
+# alternating sign via the parity bit and k! through the gamma function
+_K_SERIES = np.arange(50)[None,None,:].astype(float)
+_K_SERIES_SIGN = 1.0 - 2.0*(np.arange(50)[None,None,:] & 1)
+_K_SERIES_FACTORIAL = sp.gamma(_K_SERIES + 1.0)
+
+@njit(fastmath=True, cache=True)
+def _fista(MStack, MStackStar, b, mu, L, x0, nHeight, nZernike, maxIter, tol):
+    """Accelerated proximal-gradient (FISTA) loop for the height-grouped l1 problem
+
+    The whole iteration is compiled, so no Python closures are dispatched inside
+    the loop and the matvecs go straight to BLAS through np.dot
+    """
+    tau = 1.0 / L
+    x = x0.copy()
+    xOld = x0.copy()
+    y = x0.copy()
+    t = 1.0
+    for loop in range(maxIter):
+        residual = np.dot(MStack, y) - b
+        g = y - tau * np.dot(MStackStar, residual)
+
+# Soft-threshold the power of each metapupil, shrinking all its Zernike coefficients together
+        coef = g.reshape((nHeight, nZernike))
+        for i in range(nHeight):
+            power = 0.0
+            for j in range(nZernike):
+                power += coef[i,j]**2
+            powerThr = max(power - tau * mu, 0.0)
+            ratio = 0.0
+            if (power > 0.0):
+                ratio = powerThr / power
+            for j in range(nZernike):
+                coef[i,j] *= ratio
+        x = coef.reshape(nHeight*nZernike)
+
+        tNew = 0.5 * (1.0 + np.sqrt(1.0 + 4.0*t*t))
+        y = x + (t - 1.0) / tNew * (x - xOld)
+        t = tNew
+
+        if (np.linalg.norm(x - xOld) / tau < tol):
+            break
+        xOld = x.copy()
+
+    return x
 
 class tomography(object):
     """This class defines an atmosphere that can be used to generate synthetic MCAO observations
     and also apply different tomography schemes
     """
-    def __init__(self, nStars, nZernike, fov, heights, DTel, wavelength=5000., verbose=True, numericalProjection=True, addPiston=False):
+    def __init__(self, nStars, nZernike, fov, heights, DTel, wavelength=5000., verbose=True, numericalProjection=True, addPiston=False, seed=123):
         """Class creation
         
         Args:
@@ -31,6 +79,7 @@ class tomography(object):
             verbose (bool, optional): turn on verbosity
             numericalProjection (bool, optional): use the numerical approach for computing the projection matrix for the footprints
             addPiston (bool, optional): add piston mode
+            seed (int, optional): seed for the random number generator used for the turbulence draws
         """
         self.nHeight = len(heights)
         self.nStars = nStars
@@ -50,10 +99,6 @@ class tomography(object):
 
         self.DMetapupil = self.DTel + self.heights * self.fov
 
-        self.t = np.zeros((self.nHeight,self.nStars))
-        self.beta = np.zeros((self.nHeight,self.nStars))
-        self.angle = np.zeros((self.nHeight,self.nStars))
-
         if (self.verbose):
             print("-------------------------------------------------------------------")
             print(" - Zernike modes: {0}".format(self.nZernike))
@@ -62,23 +107,38 @@ class tomography(object):
             print(" - Number of stars : {0}".format(self.nStars))
             print("-------------------------------------------------------------------")
 
-        for i in range(self.nHeight):            
-            for j in range(self.nStars-1):
-                self.t[i,j] = (self.heights[i] * self.fov) / self.DMetapupil[i]
-                self.beta[i,j] = self.DMetapupil[i] / self.DTel
-                self.angle[i,j] = j * 2.0 * np.pi / (self.nStars - 1.0)
-            self.t[i,-1] = 0.0
-            self.beta[i,-1] = self.DMetapupil[i] / self.DTel
-            self.angle[i,-1] = 0.0
-        
-        if (self.projectionExists() == 0):
-            if (self.verbose):
-                print("Projection matrix does not exist")
-            self.computeProjection()
+# Stars on a ring plus a final on-axis star, broadcast over all heights
+        self.t = np.broadcast_to(((self.heights * self.fov) / self.DMetapupil)[:,None], (self.nHeight,self.nStars)).copy()
+        self.beta = np.broadcast_to((self.DMetapupil / self.DTel)[:,None], (self.nHeight,self.nStars)).copy()
+        self.angle = np.broadcast_to(np.arange(self.nStars) * 2.0 * np.pi / (self.nStars - 1.0), (self.nHeight,self.nStars)).copy()
+        self.t[:,-1] = 0.0
+        self.angle[:,-1] = 0.0
+
+        self._cacheKey = (tuple(self.heights), self.nStars, self.nZernike, self.fov, self.DTel)
+        if (self._cacheKey in _M_CACHE):
+            self.M, self.MStack = _M_CACHE[self._cacheKey]
+            self.MComputed = True
+        else:
+            if (self.projectionExists() == 0):
+                if (self.verbose):
+                    print("Projection matrix does not exist")
+                self.computeProjection()
+            _M_CACHE[self._cacheKey] = (self.M, self.MStack)
 
         self.aStack = {}
         self.a = {}
 
+        self._MtM = None
+        self._cholCache = {}
+        self._LMStack = None
+        self._bWFS = None
+        self._covL = None
+        self._invCov = None
+        self._Ax = None
+        self._Atx = None
+
+        self.rng = np.random.default_rng(seed)
+
 # Read cn2 file
         cn2 = np.loadtxt('cn2.dat')
 
@@ -99,33 +159,50 @@ class tomography(object):
         """
         files = glob.glob('matrices/transformationMatrices*.npz')
         for f in files:
-            out = np.load(f)
-            heights = out['arr_1']
-            nStars = out['arr_2']
-            nZernike = out['arr_3']
-            fov = out['arr_4']
-            DTel = out['arr_5']
-            ind = np.where(np.in1d(heights, self.heights))[0]
-            if (len(ind) == self.nHeight):
-                if (nStars == self.nStars and nZernike >= self.nZernike and 
-                    fov == self.fov and DTel == self.DTel):
-                    self.M = out['arr_0'][0:self.nZernike,0:self.nZernike,ind,:]
-                    if (self.verbose):
-                        print("Projection matrix exists : {0}".format(f))
-                        print(" - Zernike modes: {0}".format(self.nZernike))
-                        print(" - Number of heights : {0} -> {1} km".format(self.nHeight, self.heights * 1e-3))
-                        print(" - FOV: {0} arcsec".format(206265.*self.fov))
-                        print(" - Number of stars : {0}".format(self.nStars))
-                        self.MComputed = True
-                        self.stackProjection()
-                    return True
-                
+            out = np.load(f, mmap_mode='r')
+            try:
+# Check the small metadata arrays first so mismatching files are discarded without
+# ever touching the bulk projection tensor
+                heights = out['arr_1']
+                nStars = out['arr_2']
+                nZernike = out['arr_3']
+                fov = out['arr_4']
+                DTel = out['arr_5']
+                if (nStars != self.nStars or nZernike < self.nZernike or
+                    fov != self.fov or DTel != self.DTel):
+                    continue
+                ind = np.where(np.in1d(heights, self.heights))[0]
+                if (len(ind) != self.nHeight):
+                    continue
+
+                MFile = out['arr_0']
+# Files written before M became (nHeight,nStars,nZernike,nZernike) store the legacy
+# (nZernike,nZernike,nHeight,nStars) layout
+                if (MFile.shape[0] == nZernike and MFile.shape[1] == nZernike):
+                    MFile = np.transpose(MFile, (2,3,0,1))
+# Materialize only the slice that is actually needed
+                self.M = np.ascontiguousarray(MFile[ind,:,0:self.nZernike,0:self.nZernike])
+                if (self.verbose):
+                    print("Projection matrix exists : {0}".format(f))
+                    print(" - Zernike modes: {0}".format(self.nZernike))
+                    print(" - Number of heights : {0} -> {1} km".format(self.nHeight, self.heights * 1e-3))
+                    print(" - FOV: {0} arcsec".format(206265.*self.fov))
+                    print(" - Number of stars : {0}".format(self.nStars))
+                self.MComputed = True
+                self.stackProjection()
+                return True
+            finally:
+                out.close()
+
         return False
 
     def plotPupils(self):
         """Plot the pupils
                 
         """
+        import matplotlib.pyplot as pl
+        import seaborn as sns
+
         ncols = int(np.ceil(np.sqrt(self.nHeight)))
         nrows = int(np.ceil(self.nHeight / ncols))
         cmap = sns.color_palette(n_colors=self.nStars)
@@ -154,17 +231,21 @@ class tomography(object):
             None
         """
         if (not self.MComputed):
-            self.M = np.zeros((self.nZernike,self.nZernike,self.nHeight,self.nStars))
-            for i in range(self.nHeight):
-                print("\n**********************\n")
-                print("Height: {0}/{1}\n".format(i+1,self.nHeight))
-                print("**********************\n")
-                for j in range(self.nStars):
-                    print("\n  - Star: {0}/{1}".format(j+1,self.nStars))
-                    if (self.numericalProjection):
-                        self.M[:,:,i,j] = projection.zernikeProjectionMatrixNumerical(self.nZernike, self.beta[i,j], self.t[i,j], self.angle[i,j], verbose=True, radius=128, includePiston=False)
-                    else:
-                        self.M[:,:,i,j] = projection.zernikeProjectionMatrix(self.nZernike, self.beta[i,j], self.t[i,j], self.angle[i,j], verbose=True, includePiston=False)
+            self.M = np.zeros((self.nHeight,self.nStars,self.nZernike,self.nZernike))
+
+# Each (height, star) cell is an independent projection, so compute them in parallel
+            tasks = [(i,j) for i in range(self.nHeight) for j in range(self.nStars)]
+            if (self.verbose):
+                print("Computing projection matrix for {0} heights x {1} stars".format(self.nHeight, self.nStars))
+            if (self.numericalProjection):
+                results = Parallel(n_jobs=-1, backend='loky')(delayed(projection.zernikeProjectionMatrixNumerical)(self.nZernike,
+                    self.beta[i,j], self.t[i,j], self.angle[i,j], verbose=False, radius=128, includePiston=False) for i,j in tasks)
+            else:
+                results = Parallel(n_jobs=-1, backend='loky')(delayed(projection.zernikeProjectionMatrix)(self.nZernike,
+                    self.beta[i,j], self.t[i,j], self.angle[i,j], verbose=False, includePiston=False) for i,j in tasks)
+            for (i,j), M in zip(tasks, results):
+                self.M[i,j] = M
+
             np.savez('matrices/transformationMatrices_{0}.npz'.format(uuid.uuid4()), self.M, self.heights, self.nStars, self.nZernike, self.fov, self.DTel)
             self.stackProjection()
 
@@ -174,14 +255,8 @@ class tomography(object):
         Returns:
             None
         """
-        self.MStack = np.zeros((self.nZernike*self.nStars, self.nZernike*self.nHeight))
-        for i in range(self.nHeight):
-            for j in range(self.nStars):
-                left = i*self.nZernike
-                right = (i+1)*self.nZernike
-                up = j*self.nZernike
-                down = (j+1)*self.nZernike
-                self.MStack[up:down,left:right] = self.M[:,:,i,j]
+# MStack[j*nZ+k, i*nZ+l] = M[i,j,k,l], which is a pure layout transform
+        self.MStack = np.ascontiguousarray(self.M.transpose(1,2,0,3).reshape((self.nStars*self.nZernike, self.nHeight*self.nZernike)))
 
     def generateTurbulentZernikesKolmogorov(self, r0, layers, percentages):
         """Generate the covariance matrix for the Zernike coefficients for a given value of r0 using Kolmogorov statistics
@@ -199,27 +274,44 @@ class tomography(object):
 
         # coef = np.polyfit(layersm, np.log(r0Equivalent), 1)
         # self.correction = np.exp(coef[1] + coef[0]*self.heights)
-        
+
         self.a['Original'] = np.zeros((self.nZernike,self.nHeight))
 
+# Precompute the radial/azimuthal orders and all the r0-independent factors on the full (i,j) grid
+        n, m = wf.nollIndicesVector(np.arange(self.nZernike) + self.noll0)
+        ni = n[:,None].astype(float)
+        nj = n[None,:].astype(float)
+        S = ni + nj
+        D = ni - nj
+        index = np.arange(self.nZernike)
+        mask = (m[:,None] == m[None,:]) & (((index[:,None] - index[None,:]) & 1) == 0)
+        phase = np.where((((n[:,None] + n[None,:] - 2*m[:,None]) // 2) & 1) == 0, 1.0, -1.0)
+        logt2 = sp.gammaln(14.0/3.0) + sp.gammaln(0.5*(S - 5.0/3.0))
+        logt3 = sp.gammaln(0.5*(D + 17.0/3.0)) + sp.gammaln(0.5*(-D + 17.0/3.0)) + sp.gammaln(0.5*(S + 23.0/3.0))
+# gammaln returns log|gamma|, so the signs of the gammas that can go negative have to
+# be restored explicitly: the two D-dependent ones for |D| >= 6 and the S-dependent one
+# in logt2, whose argument is -5/6 for the piston-piston entry when addPiston=True
+        sign = sp.gammasgn(0.5*(S - 5.0/3.0)) * sp.gammasgn(0.5*(D + 17.0/3.0)) * sp.gammasgn(0.5*(-D + 17.0/3.0))
+
+# The covariances of all layers share the same r0-independent base, so factor it once
+# and sample through the Cholesky factor instead of np.random.multivariate_normal,
+# which redoes an SVD of the covariance on every call
+        covarianceBase = mask * phase * sign * np.sqrt((ni+1.0)*(nj+1.0)) * np.pi**(8.0/3.0) * 0.0072 * np.exp(logt2 - logt3)
+        covLBase = np.linalg.cholesky(covarianceBase + 1e-12*np.eye(self.nZernike))
+
         for k in range(self.nHeight):
             if (self.heights[k] in layersm):
                 whichLayer = layersm.index(self.heights[k])
-                self.covariance = np.zeros((self.nZernike,self.nZernike))
-                for i in range(self.nZernike):
-                    ni, mi = wf.nollIndices(i+self.noll0)
-                    for j in range(self.nZernike):
-                        nj, mj = wf.nollIndices(j+self.noll0)
-                        if (even(i - j)):
-                            if (mi == mj):
-                                phase = (-1.0)**(0.5*(ni+nj-2*mi))
-                                t1 = np.sqrt((ni+1)*(nj+1)) * np.pi**(8.0/3.0) * 0.0072 * (self.DTel / r0Equivalent[whichLayer])**(5.0/3.0)
-                                t2 = sp.gamma(14./3.0) * sp.gamma(0.5*(ni+nj-5.0/3.0))
-                                t3 = sp.gamma(0.5*(ni-nj+17.0/3.0)) * sp.gamma(0.5*(nj-ni+17.0/3.0)) * sp.gamma(0.5*(ni+nj+23.0/3.0))
-                                self.covariance[i,j] = phase * t1 * t2 / t3
-
-                self.a['Original'][:,k] = np.random.multivariate_normal(np.zeros(self.nZernike), self.covariance)
-        
+                scale = (self.DTel / r0Equivalent[whichLayer])**(5.0/3.0)
+                self.covariance = scale * covarianceBase
+                self._covL = np.sqrt(scale) * covLBase
+
+                self.a['Original'][:,k] = self._covL @ self.rng.standard_normal(self.nZernike)
+
+# The cached inverse and regularized factorization depend on the covariance, so drop them
+        self._invCov = None
+        self._cholCache.pop(True, None)
+
         self.aStack['Original'] = self.a['Original'].T.flatten()
 
 
@@ -233,37 +325,48 @@ class tomography(object):
         Returns:
             None
         """
-        self.covariance = np.zeros((self.nZernike,self.nZernike))
-        for i in range(self.nZernike):
-            ni, mi = wf.nollIndices(i+self.noll0)
-            for j in range(self.nZernike):
-                nj, mj = wf.nollIndices(j+self.noll0)
-                if (even(i - j)):
-                    if (mi == mj):
-                        phase = (-1.0)**(0.5*(ni+nj-2*mi))
-                        t1 = np.sqrt((ni+1)*(nj+1)) * np.pi**(8.0/3.0) * 1.16 * (self.DTel / r0)**(5.0/3.0)
-
-                        for k in range(50):
-                            phase2 = (-1.0)**k / np.math.factorial(k) * (np.pi*self.DTel / L0)**(2.0*k+ni+nj-5.0/3.0)
-                            t2 = sp.gamma(k+0.5*(3+ni+nj)) * sp.gamma(k+2+0.5*(ni+nj)) * sp.gamma(k+1+0.2*(ni+nj)) * sp.gamma(5./6.-k-0.5*(ni+nj))
-                            t3 = sp.gamma(3+k+ni+nj) * sp.gamma(2+k+ni) * sp.gamma(2+k+nj)
-
-                            phase3 = (np.pi*self.DTel / L0)**(2.0*k)
-                            t4 = sp.gamma(0.5*(ni+nj)-5./6.-k) * sp.gamma(k+7./3.) * sp.gamma(k+17/6) * sp.gamma(k+11/6)
-                            t5 = sp.gamma(0.5*(ni+nj)+23/6.+k) * sp.gamma(0.5*(ni-nj)+17/6.+k) * sp.gamma(0.5*(ni-nj)+17/6.+k)
-                            self.covariance[i,j] += phase * t1 * (phase2 * t2/t3 + phase3 * t4/t5)
-
-        self.a['Original'] = np.random.multivariate_normal(np.zeros(self.nZernike), self.covariance, size=(self.nHeight)).T        
+# Broadcast the k-sum over the full (i,j) grid: ni, nj have shape (nZ,nZ,1) and k has shape (1,1,50)
+        n, m = wf.nollIndicesVector(np.arange(self.nZernike) + self.noll0)
+        ni = n[:,None,None].astype(float)
+        nj = n[None,:,None].astype(float)
+        S = ni + nj
+        D = ni - nj
+        index = np.arange(self.nZernike)
+        mask = (m[:,None] == m[None,:]) & (((index[:,None] - index[None,:]) & 1) == 0)
+        phase = np.where((((n[:,None] + n[None,:] - 2*m[:,None]) // 2) & 1) == 0, 1.0, -1.0)
+        t1 = np.sqrt((n[:,None]+1.0)*(n[None,:]+1.0)) * np.pi**(8.0/3.0) * 1.16 * (self.DTel / r0)**(5.0/3.0)
+
+        k = _K_SERIES
+        phase2 = _K_SERIES_SIGN / _K_SERIES_FACTORIAL * (np.pi*self.DTel / L0)**(2.0*k+S-5.0/3.0)
+        t2 = sp.gamma(k+0.5*(3+S)) * sp.gamma(k+2+0.5*S) * sp.gamma(k+1+0.2*S) * sp.gamma(5./6.-k-0.5*S)
+        t3 = sp.gamma(3+k+S) * sp.gamma(2+k+ni) * sp.gamma(2+k+nj)
+
+        phase3 = (np.pi*self.DTel / L0)**(2.0*k)
+        t4 = sp.gamma(0.5*S-5./6.-k) * sp.gamma(k+7./3.) * sp.gamma(k+17/6) * sp.gamma(k+11/6)
+        t5 = sp.gamma(0.5*S+23/6.+k) * sp.gamma(0.5*D+17/6.+k) * sp.gamma(0.5*D+17/6.+k)
+
+        self.covariance = mask * phase * t1 * np.sum(phase2 * t2/t3 + phase3 * t4/t5, axis=-1)
+
+# The cached inverse and regularized factorization depend on the covariance, so drop them
+        self._invCov = None
+        self._cholCache.pop(True, None)
+
+# The covariance is SPD by construction, so the Cholesky sampler avoids the default
+# SVD of the legacy API
+        self.a['Original'] = self.rng.multivariate_normal(np.zeros(self.nZernike), self.covariance, size=(self.nHeight), method='cholesky').T        
         self.aStack['Original'] = self.a['Original'].T.flatten()
 
     def generateWFS(self):
         """Generate a WFS taking into account all heights
         
         Returns:
-            float: array of Zernike coefficients measured in all WFS
+            float: array of Zernike coefficients measured in all WFS. The same buffer is
+            reused on every call, so callers may add noise to it in-place
         """
-        return self.MStack @ self.aStack['Original']
-        # self.bStack += np.random.normal(loc=0.0, scale=0.05, size=self.bStack.shape)
+        if (self._bWFS is None):
+            self._bWFS = np.empty(self.nStars*self.nZernike)
+        np.dot(self.MStack, self.aStack['Original'], out=self._bWFS)
+        return self._bWFS
 
 
     def solveSVD(self, b, regularize=False):
@@ -276,22 +379,113 @@ class tomography(object):
         Returns:
             None
         """
+        if (regularize not in self._cholCache):
+            if (self._MtM is None):
+                self._MtM = self.MStack.T @ self.MStack
+
+            if (regularize):
+# All diagonal blocks of the regularizer are equal, so instead of building the dense
+# block-diagonal matrix we add invCov.T @ invCov into the diagonal blocks in-place
+                if (self._invCov is None):
+                    self._invCov = np.linalg.inv(self.covariance)
+                C = self._invCov.T @ self._invCov
+                AtA = self._MtM.copy()
+                view = AtA.reshape((self.nHeight,self.nZernike,self.nHeight,self.nZernike))
+                index = np.arange(self.nHeight)
+                view[index,:,index,:] += C
+            else:
+                AtA = self._MtM
+
+# AtA is symmetric positive-definite, so a Cholesky factorization is cheaper and
+# better conditioned than a general LU solve
+            self._cholCache[regularize] = spla.cho_factor(AtA, lower=True, check_finite=False)
+
+        x = spla.cho_solve(self._cholCache[regularize], self.MStack.T @ b, check_finite=False)
+
+        self.aStack['SVD'] = x
+        self.a['SVD'] = self.aStack['SVD'].reshape((self.nHeight,self.nZernike)).T
+
+    def solveLSMR(self, b, damp=0.0, regularize=False, maxIter=None):
+        """Solve the tomography using the iterative LSMR least-squares solver
+
+        LSMR works on MStack directly instead of forming the normal equations, which
+        squares the condition number of the system. A plain l2 penalty maps to the damp
+        parameter; the covariance-weighted Tikhonov term is applied by stacking invCov
+        below MStack for every height through a LinearOperator, without ever building
+        the block-diagonal matrix
+
+        Args:
+            b (TYPE): array of WFS measurements
+            damp (float, optional): l2 damping on the solution norm
+            regularize (bool, optional): apply Tikhonov regularization using the covariance matrix of the Zernike coefficients
+            maxIter (int, optional): maximum number of LSMR iterations. Defaults to
+                8x the number of unknowns, since the regularized stacked system needs
+                well over scipy's default of min(A.shape) iterations to converge
+
+        Returns:
+            None
+        """
+        nCols = self.nHeight*self.nZernike
+        if (maxIter is None):
+            maxIter = 8*nCols
+
         if (regularize):
-            invCov = np.linalg.inv(self.covariance)
-            matrixList = [invCov for i in range(self.nHeight)]
-            cov = spla.block_diag(*matrixList)
-            AInv = np.linalg.inv(self.MStack.T@self.MStack + cov.T@cov)
+            if (self._invCov is None):
+                self._invCov = np.linalg.inv(self.covariance)
+            invCov = self._invCov
+            nRows = self.nStars*self.nZernike
+
+            def matvec(x):
+                coef = x.reshape((self.nHeight,self.nZernike))
+                return np.concatenate((self.MStack @ x, (coef @ invCov.T).flatten()))
+
+            def rmatvec(y):
+                coef = y[nRows:].reshape((self.nHeight,self.nZernike))
+                return self.MStack.T @ y[0:nRows] + (coef @ invCov).flatten()
+
+            A = splinalg.LinearOperator((nRows+nCols, nCols), matvec=matvec, rmatvec=rmatvec)
+            x, istop, itn = splinalg.lsmr(A, np.concatenate((b, np.zeros(nCols))), atol=1e-8, btol=1e-8, maxiter=maxIter)[0:3]
         else:
-            AInv = np.linalg.inv(self.MStack.T@self.MStack)
+            x, istop, itn = splinalg.lsmr(self.MStack, b, damp=damp, atol=1e-8, btol=1e-8, maxiter=maxIter)[0:3]
+
+        if (istop == 7):
+            warnings.warn("LSMR hit the iteration limit ({0} iterations) before converging; "
+                "the stored solution is not the minimizer. Increase maxIter".format(itn))
 
-        x = AInv @ self.MStack.T @ b
-        
         self.aStack['SVD'] = x
         self.a['SVD'] = self.aStack['SVD'].reshape((self.nHeight,self.nZernike)).T
 
     def _g(self, x):
         return self.mu * np.linalg.norm(x, 1)
 
+    def _spectralNormSq(self, tol=1e-8, maxIter=1000):
+        """Largest squared singular value of MStack, i.e. the Lipschitz constant of the
+        gradient of the data term, computed with a power iteration on MStack.T @ MStack
+        instead of a full SVD. MStack is fixed after construction, so the value is cached
+
+        Args:
+            tol (float, optional): relative tolerance on the Rayleigh quotient
+            maxIter (int, optional): maximum number of power iterations
+
+        Returns:
+            float: ||MStack||_2^2
+        """
+        if (self._LMStack is None):
+            if (self._MtM is None):
+                self._MtM = self.MStack.T @ self.MStack
+            v = np.random.RandomState(0).randn(self._MtM.shape[0])
+            v /= np.linalg.norm(v)
+            lam = 0.0
+            for i in range(maxIter):
+                w = self._MtM @ v
+                lamNew = v @ w
+                v = w / np.linalg.norm(w)
+                if (np.abs(lamNew - lam) <= tol*lamNew):
+                    break
+                lam = lamNew
+            self._LMStack = lamNew
+        return self._LMStack
+
     def _proxL0Height(self, x, t):
         coef = x.reshape((self.nHeight,self.nZernike))
         coefOut = np.copy(coef)
@@ -306,20 +500,18 @@ class tomography(object):
         coef = x.reshape((self.nHeight,self.nZernike))
         coefOut = np.copy(coef)
         power = np.sum(coefOut**2, axis=1)
-        
-        # powerThr = ps.sparse.proxes.prox_l1(power / self.correction, t*self.mu) * self.correction
-        powerThr = ps.sparse.proxes.prox_l1(power, t*self.mu)
 
-        ratio = powerThr / power
+# Soft-threshold in one vectorized pass (the powers are non-negative)
+        powerThr = np.maximum(power - t*self.mu, 0.0)
 
-        #print(len(np.where(ratio != 0)[0]))
+        ratio = powerThr / power
 
         coefOut *= ratio[:,None]
 
         return coefOut.flatten()
 
-    def _proxg(self, x, t):        
-        return ps.sparse.proxes.prox_l1(x ,t*self.mu)
+    def _proxg(self, x, t):
+        return np.sign(x) * np.maximum(np.abs(x) - t*self.mu, 0.0)
 
     def solveBSBL(self, b, lambdaPar=1e-14):
         """Solve the tomography using BSBL
@@ -350,31 +542,19 @@ class tomography(object):
         Returns:
             None    
         """
-        L = np.linalg.norm(self.MStack, 2)**2
+        L = self._spectralNormSq()
 
-        self.MStackStar = self.MStack.T
-
-        # self.numberOfLayers = numberOfLayers
+        self.MStackStar = np.ascontiguousarray(self.MStack.T)
 
-# Define the operators we need
-        A = lambda x : self.MStack @ x
-        At = lambda x : self.MStackStar @ x
-
-# ||x-b||^2
-        f = lambda x : 0.5 * np.linalg.norm(x - b, 2)**2
-        gradf = lambda x : x - b
-        
 # Regularization parameter
         if (mu is None):
-            self.mu = 0.001
-        
-        values = np.zeros_like(self.aStack['Original'])
+            mu = 0.001
+        self.mu = mu
 
-        self.mu = mu                        
-        # out = ps.sparse.fasta(A, At, f, gradf, self._g, self._proxL0Height, values, tau=1.32/L, verbose=True, tol=1e-12, maxIter=60000, accelerate=True, backtrack=False, adaptive=False)
-        out = ps.sparse.fasta(A, At, f, gradf, self._g, self._proxL1Height, values, tau=1.32/L, verbose=True, 
-            tol=1e-12, maxIter=60000, accelerate=True, backtrack=False, adaptive=False)
-        values = out.optimize()
+        x0 = np.zeros_like(self.aStack['Original'])
+
+        values = _fista(self.MStack, self.MStackStar, b, self.mu, L, x0, self.nHeight, self.nZernike,
+            maxIter=60000, tol=1e-12)
 
         self.aStack['L1'] = values
         self.a['L1'] = self.aStack['L1'].reshape((self.nHeight,self.nZernike)).T
@@ -388,15 +568,20 @@ class tomography(object):
         Returns:
             None    
         """
-        L = np.linalg.norm(self.MStack, 2)**2
+        L = self._spectralNormSq()
         
         self.MStackStar = self.MStack.T
 
         self.numberOfLayers = numberOfLayers
 
-# Define the operators we need
-        A = lambda x : self.MStack @ x
-        At = lambda x : self.MStackStar @ x
+        if (self._Ax is None):
+            self._Ax = np.empty(self.nStars*self.nZernike)
+            self._Atx = np.empty(self.nHeight*self.nZernike)
+
+# Define the operators we need. The gemvs write into preallocated buffers instead of
+# allocating a fresh result array on every iteration
+        A = lambda x : np.dot(self.MStack, x, out=self._Ax)
+        At = lambda x : np.dot(self.MStackStar, x, out=self._Atx)
         
 # Regularization parameter
         mus = [0.05]
@@ -434,15 +619,20 @@ class tomography(object):
         Returns:
             None    
         """
-        L = np.linalg.norm(self.MStack, 2)**2
+        L = self._spectralNormSq()
         
         self.MStackStar = self.MStack.T
 
         self.numberOfLayers = numberOfLayers
 
-# Define the operators we need
-        A = lambda x : self.MStack @ x
-        At = lambda x : self.MStackStar @ x
+        if (self._Ax is None):
+            self._Ax = np.empty(self.nStars*self.nZernike)
+            self._Atx = np.empty(self.nHeight*self.nZernike)
+
+# Define the operators we need. The gemvs write into preallocated buffers instead of
+# allocating a fresh result array on every iteration
+        A = lambda x : np.dot(self.MStack, x, out=self._Ax)
+        At = lambda x : np.dot(self.MStackStar, x, out=self._Atx)
         
 # Regularization parameter
         mus = [0.05]
@@ -490,7 +680,7 @@ class tomography(object):
         Returns:
             None    
         """
-        L = np.linalg.norm(self.MStack, 2)**2
+        L = self._spectralNormSq()
         
         self.MStackStar = self.MStack.T
 
@@ -513,6 +703,9 @@ class tomography(object):
         self.a['L1'] = self.aStack['L1'].reshape((self.nHeight,self.nZernike)).T
 
 def plotResults(forward, inversion):
+    import matplotlib.pyplot as pl
+    import seaborn as sns
+
     ncols = forward.nHeight
     nrows = 3
     cmap = sns.color_palette()
@@ -542,6 +735,8 @@ def plotResults(forward, inversion):
     ax[1].legend()
 
 if (__name__ == "__main__"):
+    import seaborn as sns
+
     np.random.seed(123)
     sns.set_style("dark")
     nStars = 7
@@ -99,6 +99,26 @@ def nollIndices(j):
 
   return n, m
 
+def nollIndicesVector(j):
+  """
+  Return the radial and azimuthal orders for an array of Noll indices
+
+  Args:
+      j (int): array of Zernike orders (Noll ordering)
+
+  Returns:
+      int: arrays with the radial and azimuthal orders
+  """
+  j = numpy.atleast_1d(j).astype(int)
+  narr = numpy.arange(40)
+  jmax = (narr+1)*(narr+2)//2
+  n = numpy.searchsorted(jmax, j)
+  mprime = j - n*(n+1)//2
+  m = numpy.where(n % 2 == 0, 2*(mprime//2), 1 + 2*((mprime-1)//2))
+  m = numpy.where(j % 2 != 0, -m, m)
+
+  return n, m
+
 def aperture(npix=256, cent_obs=0.0, spider=0):
   """
   Compute the aperture image of a telescope